@@ -1,6 +1,13 @@
 import streamlit as st
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectionError as BotoConnectionError, HTTPClientError
 import json
+import logging
+import threading
+import time
+from collections import deque
+from itertools import chain, islice
 from datetime import datetime
 
 # --- AWS Bedrock Configuration ---
@@ -17,12 +24,81 @@ MODEL_ID = "anthropic.claude-3-7-sonnet-20250219-v1:0"
 # Construct the full Model ARN
 MODEL_ARN = f"arn:aws:bedrock:{BEDROCK_REGION}::foundation-model/{MODEL_ID}"
 
-# Initialize Boto3 Bedrock Agent Runtime client
-try:
-    bedrock_agent_runtime_client = boto3.client(
+# Generation prompt for every question; Bedrock fills in the retrieved excerpts
+# and its citation instructions, and sends the question itself as the user turn
+KB_PROMPT_TEMPLATE = (
+    "You are a question answering assistant for a personal email archive. "
+    "Answer only from the retrieved email excerpts, mention the sender and date "
+    "of the emails you rely on, and say so plainly if the excerpts do not contain the answer.\n\n"
+    "Here are the search results from the email archive:\n"
+    "$search_results$\n\n"
+    "$output_format_instructions$"
+)
+
+# Shared retrieve-and-generate configuration, built once instead of per question
+RETRIEVE_AND_GENERATE_CONFIG = {
+    'type': 'KNOWLEDGE_BASE',
+    'knowledgeBaseConfiguration': {
+        'knowledgeBaseId': KNOWLEDGE_BASE_ID,
+        'modelArn': MODEL_ARN,
+        'generationConfiguration': {
+            'promptTemplate': {
+                'textPromptTemplate': KB_PROMPT_TEMPLATE
+            }
+        }
+    }
+}
+
+@st.cache_resource
+def get_bedrock_client(region):
+    """Builds the Bedrock Agent Runtime client once and shares it across reruns and sessions."""
+    return boto3.client(
         "bedrock-agent-runtime",
-        region_name=BEDROCK_REGION
+        region_name=region,
+        config=Config(
+            connect_timeout=3, # Fail fast on network flakes instead of the 60s default
+            read_timeout=120, # Long answers stream for a while; don't cut them off
+            retries={"max_attempts": 3, "mode": "adaptive"},
+            tcp_keepalive=True,
+            max_pool_connections=32
+        )
     )
+
+# Idle connections to Bedrock get reaped after about a minute; pinging more often than
+# that means the next question reuses a warm TLS connection instead of a new handshake
+KEEPALIVE_INTERVAL_SECONDS = 30
+
+logger = logging.getLogger(__name__)
+
+def _keep_connection_warm(client):
+    """Pings Bedrock every KEEPALIVE_INTERVAL_SECONDS; needs the bedrock:ListSessions permission."""
+    failure_logged = False
+    while True:
+        time.sleep(KEEPALIVE_INTERVAL_SECONDS)
+        try:
+            client.list_sessions(maxResults=1)
+        except (ClientError, BotoConnectionError, HTTPClientError) as e:
+            # Even an error response (e.g. AccessDenied) keeps the pooled connection alive,
+            # and network errors may clear up, so keep pinging; just say so once
+            if not failure_logged:
+                logger.warning(f"Bedrock keep-alive ping failed (will keep trying): {e}")
+                failure_logged = True
+        except Exception as e:
+            # Not an HTTP-level failure (e.g. this boto3 has no list_sessions); retrying won't help
+            logger.error(f"Bedrock keep-alive stopped: {e}")
+            return
+
+@st.cache_resource
+def start_bedrock_keepalive(_client):
+    """Starts one background keep-alive thread per process for the shared client."""
+    keepalive_thread = threading.Thread(target=_keep_connection_warm, args=(_client,), daemon=True)
+    keepalive_thread.start()
+    return keepalive_thread
+
+# Initialize Boto3 Bedrock Agent Runtime client
+try:
+    bedrock_agent_runtime_client = get_bedrock_client(BEDROCK_REGION)
+    start_bedrock_keepalive(bedrock_agent_runtime_client)
     st.sidebar.success(f"Bedrock client initialized for region: {BEDROCK_REGION}")
 except Exception as e:
     st.error(f"Error initializing Bedrock Agent Runtime client: {e}")
@@ -41,32 +117,74 @@ Ask questions about your indexed emails.
 # (Make sure the rest of the code for displaying messages, citations, and the 
 # bedrock_agent_runtime_client.retrieve_and_generate call is present)
 
+# Chat history is capped so the session state stays small on long conversations,
+# and only the most recent messages keep their (large) citation payloads
+MAX_HISTORY_MESSAGES = 100
+CITED_HISTORY_MESSAGES = 20
+
 # Initialize chat history in session state
 if "messages" not in st.session_state:
-    st.session_state.messages = []
+    st.session_state.messages = deque(maxlen=MAX_HISTORY_MESSAGES)
 
-# Display chat messages from history on app rerun
-for message in st.session_state.messages:
+SNIPPET_MAX_CHARS = 1000
+CITATIONS_PREVIEW_COUNT = 3
+
+def add_citation_snippets(citations):
+    """Stores a truncated copy of each reference's text once, so reruns don't re-slice it."""
+    for citation in citations:
+        for ref in citation.get('retrievedReferences', []):
+            content = ref.get('content', {})
+            text = content.get('text')
+            if text:
+                content['_snippet'] = text[:SNIPPET_MAX_CHARS] + ("..." if len(text) > SNIPPET_MAX_CHARS else "")
+
+def drop_old_citations(messages):
+    """Strips citations from all but the newest CITED_HISTORY_MESSAGES messages."""
+    for message in islice(messages, 0, max(0, len(messages) - CITED_HISTORY_MESSAGES)):
+        message.pop("citations", None)
+
+def show_all_citations(flag_key):
+    st.session_state[flag_key] = True
+
+def render_citations(citations, timestamp, live=False):
+    """
+    Renders the sources expander for one assistant answer.
+    Only the first CITATIONS_PREVIEW_COUNT citations are built until the user asks for the rest.
+    """
+    key_prefix = f"{'new_cite' if live else 'cite'}_{timestamp}"
+    show_all_key = f"show_all_sources_{timestamp}" # Shared by the live and replayed render of the same answer
+    shown_citations = citations if st.session_state.get(show_all_key) else citations[:CITATIONS_PREVIEW_COUNT]
+    with st.expander("📚 View Sources", expanded=live):
+        for i, citation in enumerate(shown_citations):
+            st.markdown(f"---") 
+            if citation.get('retrievedReferences'):
+                for ref_idx, ref in enumerate(citation.get('retrievedReferences', [])):
+                    st.markdown(f"**Reference {i+1}.{ref_idx+1}:**")
+                    if ref.get('location', {}).get('s3Location', {}).get('uri'):
+                        st.markdown(f"- S3 URI: `{ref['location']['s3Location']['uri']}`")
+                    if ref.get('content', {}).get('text'):
+                        st.text_area(f"Retrieved Content Snippet:", 
+                                     value=ref['content']['_snippet'], 
+                                     height=150, 
+                                     key=f"{key_prefix}_{i}_{ref_idx}",
+                                     disabled=True)
+            else:
+                st.write("No detailed references found for this citation segment.")
+        hidden_count = len(citations) - len(shown_citations)
+        if hidden_count > 0:
+            st.button(f"Show {hidden_count} more", key=f"{key_prefix}_more", on_click=show_all_citations, args=(show_all_key,))
+
+@st.fragment
+def render_message(message):
+    """Renders one past chat turn as a fragment so its widgets rerun on their own."""
     with st.chat_message(message["role"]):
         st.markdown(message["content"])
         if message["role"] == "assistant" and "citations" in message and message["citations"]:
-            with st.expander("📚 View Sources", expanded=False):
-                for i, citation in enumerate(message["citations"]):
-                    st.markdown(f"---") 
-                    if citation.get('retrievedReferences'):
-                        for ref_idx, ref in enumerate(citation.get('retrievedReferences', [])):
-                            st.markdown(f"**Reference {i+1}.{ref_idx+1}:**")
-                            if ref.get('location', {}).get('s3Location', {}).get('uri'):
-                                st.markdown(f"- S3 URI: `{ref['location']['s3Location']['uri']}`")
-                            if ref.get('content', {}).get('text'):
-                                text_area_key = f"cite_{message.get('timestamp', datetime.now().timestamp())}_{i}_{ref_idx}"
-                                st.text_area(f"Retrieved Content Snippet:", 
-                                             value=ref['content']['text'][:1000]+"..." if len(ref['content']['text']) > 1000 else ref['content']['text'], 
-                                             height=150, 
-                                             key=text_area_key,
-                                             disabled=True)
-                    else:
-                        st.write("No detailed references found for this citation segment.")
+            render_citations(message["citations"], message.get('timestamp', datetime.now().timestamp()))
+
+# Display chat messages from history on app rerun
+for message in st.session_state.messages:
+    render_message(message)
 
 if prompt := st.chat_input("Ask a question about your emails..."):
     current_timestamp = datetime.now().timestamp()
@@ -78,40 +196,37 @@ if prompt := st.chat_input("Ask a question about your emails..."):
     })
 
     try:
-        with st.spinner("Searching emails and generating answer..."):
-            response = bedrock_agent_runtime_client.retrieve_and_generate(
-                input={'text': prompt},
-                retrieveAndGenerateConfiguration={
-                    'type': 'KNOWLEDGE_BASE',
-                    'knowledgeBaseConfiguration': {
-                        'knowledgeBaseId': KNOWLEDGE_BASE_ID,
-                        'modelArn': MODEL_ARN
-                    }
-                }
-            )
-        assistant_response_text = response.get('output', {}).get('text', "Sorry, I couldn't retrieve an answer or the answer was empty.")
-        citations = response.get('citations', [])
+        citations = []
         with st.chat_message("assistant"):
-            st.markdown(assistant_response_text)
+            answer_placeholder = st.empty()
+            streamed_text = ""
+            first_output_events = []
+            with st.spinner("Searching emails and generating answer..."):
+                response = bedrock_agent_runtime_client.retrieve_and_generate_stream(
+                    input={'text': prompt},
+                    retrieveAndGenerateConfiguration=RETRIEVE_AND_GENERATE_CONFIG
+                )
+                stream = iter(response['stream'])
+                # Only spin until the first text arrives; after that the streaming answer shows progress
+                for event in stream:
+                    if 'output' in event:
+                        first_output_events.append(event)
+                        break
+                    elif 'citation' in event:
+                        citations.append(event['citation'])
+            # Render text deltas as they arrive; citations are collected and shown after the stream ends
+            for event in chain(first_output_events, stream):
+                if 'output' in event:
+                    streamed_text += event['output'].get('text', "")
+                    answer_placeholder.markdown(streamed_text)
+                elif 'citation' in event:
+                    citations.append(event['citation'])
+            add_citation_snippets(citations)
+            assistant_response_text = streamed_text or "Sorry, I couldn't retrieve an answer or the answer was empty."
+            answer_placeholder.markdown(assistant_response_text)
             if citations:
-                with st.expander("📚 View Sources", expanded=True):
-                    for i, citation in enumerate(citations):
-                        st.markdown(f"---")
-                        if citation.get('retrievedReferences'):
-                            for ref_idx, ref in enumerate(citation.get('retrievedReferences', [])):
-                                st.markdown(f"**Reference {i+1}.{ref_idx+1}:**")
-                                if ref.get('location', {}).get('s3Location', {}).get('uri'):
-                                    st.markdown(f"- S3 URI: `{ref['location']['s3Location']['uri']}`")
-                                if ref.get('content', {}).get('text'):
-                                    text_area_key_new = f"new_cite_{current_timestamp}_{i}_{ref_idx}"
-                                    st.text_area(f"Retrieved Content Snippet:", 
-                                                 value=ref['content']['text'][:1000]+"..." if len(ref['content']['text']) > 1000 else ref['content']['text'], 
-                                                 height=150, 
-                                                 key=text_area_key_new,
-                                                 disabled=True)
-                        else:
-                             st.write("No detailed references found for this citation segment.")
-            elif not assistant_response_text:
+                render_citations(citations, current_timestamp, live=True)
+            elif not streamed_text:
                  st.markdown("I found some information, but couldn't formulate a direct answer. You might want to check the sources if any were retrieved, or try rephrasing your question.")
         st.session_state.messages.append({
             "role": "assistant",
@@ -119,6 +234,7 @@ if prompt := st.chat_input("Ask a question about your emails..."):
             "citations": citations,
             "timestamp": current_timestamp
         })
+        drop_old_citations(st.session_state.messages)
     except Exception as e:
         error_message_full = f"Error querying Knowledge Base: {str(e)}"
         st.error(error_message_full)
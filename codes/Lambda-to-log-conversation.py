@@ -1,35 +1,63 @@
 import json
 import boto3
+from botocore.config import Config
 import os
-from pathlib import Path
+import gzip
 from datetime import datetime
 import logging
 import re # For sanitizing conversation ID for S3 path
+import string
+
+try:
+    import orjson # Several times faster than json; bundle it in the Lambda layer
+except ImportError:
+    orjson = None
 
 # Configure logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-# Initialize S3 client
-s3_client = boto3.client('s3')
+# Initialize S3 client (module-level so warm invocations reuse its connection pool)
+s3_client = boto3.client('s3', config=Config(tcp_keepalive=True, max_pool_connections=50))
 
 # Environment variables to be set in Lambda configuration
 LOGGING_S3_BUCKET_NAME = os.environ.get('LOGGING_S3_BUCKET_NAME')
 LOGGING_S3_BASE_PREFIX = os.environ.get('LOGGING_S3_BASE_PREFIX', 'conversation-logs') # Base prefix
 
+def to_json(obj):
+    """Serializes obj to a JSON string, using orjson when the layer provides it."""
+    if orjson:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj)
+
+def to_json_bytes(obj):
+    """Serializes obj to UTF-8 JSON bytes, ready to use as an S3 object body."""
+    if orjson:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode('utf-8')
+
+# Allow alphanumeric, hyphens, underscores, periods. Everything else becomes an underscore.
+_SANITIZE_ALLOWED = frozenset(string.ascii_letters + string.digits + '_.-')
+_SANITIZE_TABLE = {c: '_' for c in range(128) if chr(c) not in _SANITIZE_ALLOWED}
+_SANITIZE_RE = re.compile(r'[^a-zA-Z0-9_.-]')
+
 def sanitize_for_s3_path(text, max_length=50):
     """Sanitizes a string to be safe for S3 path components."""
     if not text:
         return "unknown"
-    # Remove characters not typically allowed or problematic in S3 paths/filenames
-    # Allow alphanumeric, hyphens, underscores, periods. Replace others with underscore.
-    sanitized = re.sub(r'[^a-zA-Z0-9_.-]', '_', str(text))
-    return sanitized[:max_length]
+    # Replacement is one-for-one, so truncating first gives the same result with less work
+    text = str(text)[:max_length]
+    if text.isascii():
+        return text.translate(_SANITIZE_TABLE)
+    return _SANITIZE_RE.sub('_', text)
 
 def lambda_handler(event, context):
-    logger.info(f"Received event for logging: {json.dumps(event)}")
+    if logger.isEnabledFor(logging.DEBUG): # Skip serializing the payload at INFO level
+        logger.debug(f"Received event for logging: {to_json(event)}")
 
     text_to_log = ''
+    user_question = ''
+    agent_response = ''
     # Use session ID from agent if available, otherwise generate one for the conversation
     # The agent should ideally pass $sessionId as conversationId
     conversation_id = 'unknown_conversation_' + datetime.now().strftime("%Y%m%d") 
@@ -39,21 +67,24 @@ def lambda_handler(event, context):
 
     try:
         properties = event.get('requestBody', {}).get('application/json', {}).get('properties', [])
-        logger.info(f"Extracted properties for logging: {json.dumps(properties)}")
-
-        for prop in properties:
-            prop_name = prop.get('name')
-            prop_value = prop.get('value')
-
-            if prop_name == 'textToLog':
-                if isinstance(prop_value, str):
-                    text_to_log = prop_value
-            elif prop_name == 'conversationId': # Agent should pass $sessionId here
-                if isinstance(prop_value, str) and prop_value.strip():
-                    conversation_id = prop_value.strip()
-            elif prop_name == 'logType': # "user_question" or "agent_response"
-                if isinstance(prop_value, str) and prop_value.strip():
-                    log_type = prop_value.strip()
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Extracted properties for logging: {to_json(properties)}")
+
+        # One pass to index the properties by name, then direct lookups
+        props = {prop.get('name'): prop.get('value') for prop in properties}
+
+        if isinstance(props.get('textToLog'), str):
+            text_to_log = props['textToLog']
+        conversation_id_value = props.get('conversationId') # Agent should pass $sessionId here
+        if isinstance(conversation_id_value, str) and conversation_id_value.strip():
+            conversation_id = conversation_id_value.strip()
+        log_type_value = props.get('logType') # "user_question", "agent_response" or "conversation_turn"
+        if isinstance(log_type_value, str) and log_type_value.strip():
+            log_type = log_type_value.strip()
+        if isinstance(props.get('userQuestion'), str): # Only used with logType "conversation_turn"
+            user_question = props['userQuestion']
+        if isinstance(props.get('agentResponse'), str): # Only used with logType "conversation_turn"
+            agent_response = props['agentResponse']
         
         logger.info(f"Parsed textToLog: {'Present' if text_to_log else 'MISSING!'}")
         logger.info(f"Parsed conversationId: {conversation_id}")
@@ -63,12 +94,16 @@ def lambda_handler(event, context):
         logger.error(f"Error parsing input parameters for logging: {e}", exc_info=True)
         return format_agent_response(event, 400, {"error": f"Error parsing input parameters: {str(e)}"})
 
-    if not text_to_log:
+    if log_type not in ['user_question', 'agent_response', 'conversation_turn']: # Validate logType
+        logger.warning(f"Invalid 'logType' provided: {log_type}.")
+        return format_agent_response(event, 400, {"error": "logType must be 'user_question', 'agent_response' or 'conversation_turn'."})
+    if log_type == 'conversation_turn':
+        if not user_question or not agent_response:
+            logger.warning("'conversation_turn' log is missing 'userQuestion' or 'agentResponse'.")
+            return format_agent_response(event, 400, {"error": "conversation_turn requires both userQuestion and agentResponse."})
+    elif not text_to_log:
         logger.warning("No 'textToLog' provided.")
         return format_agent_response(event, 400, {"error": "No text provided to log."})
-    if log_type not in ['user_question', 'agent_response']: # Validate logType
-        logger.warning(f"Invalid 'logType' provided: {log_type}.")
-        return format_agent_response(event, 400, {"error": "logType must be 'user_question' or 'agent_response'."})
     if not LOGGING_S3_BUCKET_NAME:
         logger.error("LOGGING_S3_BUCKET_NAME environment variable is not set.")
         return format_agent_response(event, 500, {"error": "Lambda configuration error: Target S3 bucket for logging not set."})
@@ -76,17 +111,32 @@ def lambda_handler(event, context):
     sanitized_conv_id = sanitize_for_s3_path(conversation_id)
     sanitized_log_type = sanitize_for_s3_path(log_type)
 
-    filename = f"{sanitized_log_type}_{timestamp_for_file}.txt"
-    # S3 Key: base_prefix/sanitized_conversation_id_folder/filename.txt
-    s3_key = str(Path(LOGGING_S3_BASE_PREFIX) / sanitized_conv_id / filename).replace("\\", "/")
+    if log_type == 'conversation_turn':
+        # One JSON line holding both sides of the turn, so a turn costs a single PUT instead of two
+        filename = f"{sanitized_log_type}_{timestamp_for_file}.jsonl"
+        body = to_json_bytes({
+            "timestamp": timestamp_for_file,
+            "conversationId": conversation_id,
+            "userQuestion": user_question,
+            "agentResponse": agent_response
+        }) + b"\n"
+        content_type = 'application/x-ndjson'
+    else:
+        filename = f"{sanitized_log_type}_{timestamp_for_file}.txt"
+        body = text_to_log.encode('utf-8')
+        content_type = 'text/plain'
+    # S3 Key: base_prefix/sanitized_conversation_id_folder/filename
+    s3_key = "/".join(part for part in (LOGGING_S3_BASE_PREFIX.strip('/'), sanitized_conv_id, filename) if part)
 
     try:
         logger.info(f"Saving log to s3://{LOGGING_S3_BUCKET_NAME}/{s3_key}")
         s3_client.put_object(
             Bucket=LOGGING_S3_BUCKET_NAME,
             Key=s3_key,
-            Body=text_to_log.encode('utf-8'),
-            ContentType='text/plain'
+            Body=gzip.compress(body, compresslevel=1), # Text logs shrink several-fold even at the fastest level
+            ContentType=content_type,
+            ContentEncoding='gzip',
+            CacheControl='max-age=31536000, immutable' # Keys embed a microsecond timestamp, so objects never change
         )
         
         s3_log_path = f"s3://{LOGGING_S3_BUCKET_NAME}/{s3_key}"
@@ -106,32 +156,22 @@ def lambda_handler(event, context):
         return format_agent_response(event, 500, {"error": f"Internal server error during S3 save: {str(e)}"})
 
 def format_agent_response(event_payload, http_status_code, response_data):
-    response_body_content = {
-        'application/json': {
-            'body': json.dumps(response_data)
-        }
-    }
-    action_group_name = event_payload.get('actionGroup', {}) # Get the whole dict
+    get = event_payload.get
+    action_group_name = get('actionGroup', {}) # Get the whole dict
     if isinstance(action_group_name, dict):
         action_group_name = action_group_name.get('actionGroupName') # Extract the name
     if not action_group_name: # Default if still not found
-        action_group_name = event_payload.get('actionGroup', 'UnknownActionGroup_Log')
-
-
-    api_path = event_payload.get('apiPath', '/logConversationTurn') # Default to your expected API path
-    http_method = event_payload.get('httpMethod', 'POST')
+        action_group_name = get('actionGroup', 'UnknownActionGroup_Log')
 
-    agent_response = {
+    return {
         'messageVersion': '1.0', 
         'response': {
             'actionGroup': action_group_name,
-            'apiPath': api_path,
-            'httpMethod': http_method,
+            'apiPath': get('apiPath', '/logConversationTurn'), # Default to your expected API path
+            'httpMethod': get('httpMethod', 'POST'),
             'httpStatusCode': http_status_code,
-            'responseBody': response_body_content
+            'responseBody': {'application/json': {'body': to_json(response_data)}}
         },
-        'sessionAttributes': event_payload.get('sessionAttributes', {}),
-        'promptSessionAttributes': event_payload.get('promptSessionAttributes', {})
+        'sessionAttributes': get('sessionAttributes') or {},
+        'promptSessionAttributes': get('promptSessionAttributes') or {}
     }
-    logger.info(f"Returning agent response for logging action: {json.dumps(agent_response)}")
-    return agent_response
\ No newline at end of file
@@ -1,26 +1,188 @@
 import json
 import boto3
+from botocore.config import Config
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
 import os
-import shutil
+import io
+import queue
 from pathlib import Path
 from datetime import datetime
 import zipfile
 import logging
 from urllib.parse import urlparse
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+try:
+    import orjson # Several times faster than json; bundle it in the Lambda layer
+except ImportError:
+    orjson = None
 
 # Configure logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-# Initialize S3 client
-s3_client = boto3.client('s3')
+# Initialize S3 client (module-level so warm invocations reuse its connection pool)
+s3_client = boto3.client('s3', config=Config(tcp_keepalive=True, max_pool_connections=50, retries={'mode': 'adaptive'}))
+
+# Number of S3 objects fetched concurrently; kept below max_pool_connections.
+# It also caps how many bodies are held at once (downloading or waiting to be zipped).
+DOWNLOAD_MAX_WORKERS = 16
+
+# Archives smaller than this are built in memory and sent with a single PutObject;
+# larger ones are streamed as a multipart upload while the zip is still being written
+ARCHIVE_SPOOL_THRESHOLD = 16 * 1024 * 1024
+
+# Zip output waiting for the streamed upload; the zip writer blocks once this many
+# chunks are queued, so a slow upload cannot pile the whole archive up in memory
+ARCHIVE_QUEUE_MAX_CHUNKS = 16
+
+# One transfer manager for the life of the container, so warm invocations reuse its
+# thread pool instead of upload_fileobj() building and tearing down a new one per call
+archive_transfer_manager = create_transfer_manager(
+    s3_client,
+    TransferConfig(multipart_threshold=ARCHIVE_SPOOL_THRESHOLD, max_concurrency=10, use_threads=True)
+)
 
 # Environment variables (set these in your Lambda function's configuration)
 TARGET_S3_BUCKET_NAME = os.environ.get('TARGET_S3_BUCKET_NAME')
 ARCHIVE_S3_PREFIX = os.environ.get('ARCHIVE_S3_PREFIX', 'email_archives') # Optional prefix
 
+def to_json(obj):
+    """Serializes obj to a JSON string, using orjson when the layer provides it."""
+    if orjson:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj)
+
+def from_json(text):
+    """Parses a JSON string, using orjson when the layer provides it."""
+    if orjson:
+        return orjson.loads(text)
+    return json.loads(text)
+
+class ArchiveUploadStream(io.RawIOBase):
+    """
+    Pipes bytes written by a zipfile.ZipFile straight into an S3 upload.
+    Output is held in memory until it passes ARCHIVE_SPOOL_THRESHOLD; small archives
+    are then sent with one PutObject in finish(). Past the threshold, the shared
+    transfer manager starts a streamed upload and pulls bytes through readinto()
+    on its own threads while the zip writer keeps calling write(). Either way the
+    archive never touches /tmp.
+    """
+    def __init__(self, bucket, key):
+        super().__init__()
+        self._bucket = bucket
+        self._key = key
+        self._spool = io.BytesIO()
+        self._chunks = queue.Queue(maxsize=ARCHIVE_QUEUE_MAX_CHUNKS)
+        self._pending = memoryview(b"")
+        self._upload = None
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self._upload is None:
+            self._spool.write(data)
+            if self._spool.tell() > ARCHIVE_SPOOL_THRESHOLD:
+                self._chunks.put(self._spool.getvalue())
+                self._spool = None
+                self._upload = archive_transfer_manager.upload(self, self._bucket, self._key)
+            return len(data)
+        self._put_chunk(bytes(data))
+        return len(data)
+
+    def _put_chunk(self, chunk):
+        """Queues chunk for the reader, waiting for room but not on an upload that has died."""
+        while True:
+            if self._upload.done(): # Upload died early; surface its error instead of queueing more bytes
+                self._raise_upload_error()
+            try:
+                self._chunks.put(chunk, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def _hand_to_reader(self, item):
+        """
+        Replaces whatever the reader has not consumed yet with item (EOF or an exception).
+        The transfer manager's thread may be parked in readinto() waiting for bytes, and
+        the upload only reports completion once that thread returns.
+        """
+        while True:
+            try:
+                self._chunks.get_nowait()
+            except queue.Empty:
+                break
+        self._chunks.put_nowait(item)
+
+    def _raise_upload_error(self):
+        """Unblocks the reader, then raises the failed upload's exception."""
+        self._hand_to_reader(RuntimeError("Archive upload failed"))
+        self._upload.result()
+
+    def read(self, size=-1):
+        # The transfer manager sizes multipart parts by what read(n) returns, so fill
+        # the request completely rather than returning whatever chunk is queued
+        if size is None or size < 0:
+            return self.readall()
+        parts = []
+        while size > 0:
+            part = super().read(size)
+            if not part:
+                break
+            parts.append(part)
+            size -= len(part)
+        return b"".join(parts)
+
+    def readinto(self, buffer):
+        while not self._pending:
+            chunk = self._chunks.get()
+            if chunk is None: # Writer finished; keep reporting EOF
+                self._chunks.put(None)
+                return 0
+            if isinstance(chunk, BaseException): # Writer aborted; fail the upload so S3 discards it
+                raise chunk
+            self._pending = memoryview(chunk)
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+    def finish(self):
+        """Signals end of archive and waits for the upload to complete."""
+        if self._upload is None:
+            s3_client.put_object(Bucket=self._bucket, Key=self._key, Body=self._spool.getvalue())
+            return
+        self._put_chunk(None)
+        self._upload.result()
+
+    def abort(self, reason):
+        """Fails the in-flight upload so no partial archive is left in S3."""
+        if self._upload is None: # Nothing sent yet; just drop the spooled bytes
+            self._spool = io.BytesIO()
+            return
+        self._hand_to_reader(reason)
+        try:
+            self._upload.result()
+        except Exception:
+            pass # Expected: the upload fails with the abort reason
+
+
+def fetch_s3_object(bucket, key):
+    """
+    Reads an S3 object's body into memory with a single GET.
+    download_file() would issue a HeadObject first to size the transfer, doubling
+    the round-trips for small email files.
+    """
+    return s3_client.get_object(Bucket=bucket, Key=key)['Body'].read()
+
 def lambda_handler(event, context):
-    logger.info(f"Received event: {json.dumps(event)}")
+    if logger.isEnabledFor(logging.DEBUG): # Skip serializing the payload at INFO level
+        logger.debug(f"Received event: {to_json(event)}")
 
     # Initialize parameters
     s3_uris = []
@@ -29,43 +191,44 @@ def lambda_handler(event, context):
     try:
         # Parameters from Bedrock Agent are passed in a list of properties
         properties = event.get('requestBody', {}).get('application/json', {}).get('properties', [])
-        logger.info(f"Extracted properties: {json.dumps(properties)}")
-
-        for prop in properties:
-            prop_name = prop.get('name')
-            prop_value = prop.get('value')
-            # prop_type = prop.get('type') # Available for debugging
-
-            if prop_name == 's3_uris':
-                # Value for an array type from the agent should be a list directly.
-                # If it's a string that *looks* like a list, it's usually an issue
-                # with the OpenAPI spec or how the agent constructed the call.
-                if isinstance(prop_value, list):
-                    s3_uris = [str(uri) for uri in prop_value if isinstance(uri, str)] # Ensure all items are strings
-                elif isinstance(prop_value, str): # Fallback: if agent sends it as a JSON string list
-                    try:
-                        parsed_list = json.loads(prop_value)
-                        if isinstance(parsed_list, list):
-                            s3_uris = [str(uri) for uri in parsed_list if isinstance(uri, str)]
-                        else:
-                            logger.warning(f"'s3_uris' string did not decode to a list: {prop_value}")
-                    except json.JSONDecodeError:
-                        logger.warning(f"Could not decode 's3_uris' string as JSON: {prop_value}")
-                else:
-                    logger.warning(f"'s3_uris' property is not a list or a decodable string. Type: {type(prop_value)}, Value: {prop_value}")
-            
-            elif prop_name == 'query_context':
-                if isinstance(prop_value, str):
-                    query_context = prop_value
-                else:
-                    logger.warning(f"'query_context' property is not a string. Type: {type(prop_value)}, Value: {prop_value}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Extracted properties: {to_json(properties)}")
+
+        # One pass to index the properties by name, then direct lookups
+        props = {prop.get('name'): prop.get('value') for prop in properties}
+
+        if 's3_uris' in props:
+            s3_uris_value = props['s3_uris']
+            # Value for an array type from the agent should be a list directly.
+            # If it's a string that *looks* like a list, it's usually an issue
+            # with the OpenAPI spec or how the agent constructed the call.
+            if isinstance(s3_uris_value, list):
+                s3_uris = [str(uri) for uri in s3_uris_value if isinstance(uri, str)] # Ensure all items are strings
+            elif isinstance(s3_uris_value, str): # Fallback: if agent sends it as a JSON string list
+                try:
+                    parsed_list = from_json(s3_uris_value)
+                    if isinstance(parsed_list, list):
+                        s3_uris = [str(uri) for uri in parsed_list if isinstance(uri, str)]
+                    else:
+                        logger.warning(f"'s3_uris' string did not decode to a list: {s3_uris_value}")
+                except json.JSONDecodeError: # orjson.JSONDecodeError subclasses this
+                    logger.warning(f"Could not decode 's3_uris' string as JSON: {s3_uris_value}")
+            else:
+                logger.warning(f"'s3_uris' property is not a list or a decodable string. Type: {type(s3_uris_value)}, Value: {s3_uris_value}")
+
+        if 'query_context' in props:
+            query_context_value = props['query_context']
+            if isinstance(query_context_value, str):
+                query_context = query_context_value
+            else:
+                logger.warning(f"'query_context' property is not a string. Type: {type(query_context_value)}, Value: {query_context_value}")
         
         logger.info(f"Parsed s3_uris: {s3_uris}")
         logger.info(f"Parsed query_context: {query_context}")
 
     except Exception as e:
         logger.error(f"Error parsing input parameters from event's properties: {e}", exc_info=True)
-        logger.error(f"Full event structure for parsing error: {json.dumps(event)}")
+        logger.error(f"Full event structure for parsing error: {to_json(event)}")
         return format_agent_response(event, 400, {"error": f"Error parsing input parameters: {str(e)}"})
 
     if not s3_uris:
@@ -78,52 +241,77 @@ def lambda_handler(event, context):
 
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     query_slug = "".join(filter(str.isalnum, query_context))[:30]
-    local_tmp_archive_folder_name = f"retrieved_{query_slug}_{timestamp}"
-    local_tmp_path = Path("/tmp") / local_tmp_archive_folder_name
+    zip_filename_base = f"retrieved_{query_slug}_{timestamp}"
     
     try:
-        local_tmp_path.mkdir(parents=True, exist_ok=True)
-        logger.info(f"Created temporary local folder: {local_tmp_path}")
-
-        downloaded_files_count = 0
+        download_tasks = []
         for s3_uri in s3_uris:
             if not isinstance(s3_uri, str) or not s3_uri.startswith("s3://"):
                 logger.warning(f"Invalid S3 URI format encountered: {s3_uri}. Skipping.")
                 continue
-            try:
-                parsed_uri = urlparse(s3_uri)
-                source_bucket = parsed_uri.netloc
-                source_key = parsed_uri.path.lstrip('/')
-                
-                if not source_bucket or not source_key:
-                    logger.warning(f"Invalid S3 URI structure after parsing: {s3_uri}. Skipping.")
-                    continue
-
-                filename = Path(source_key).name
-                local_file_path = local_tmp_path / filename
-                
-                logger.info(f"Downloading s3://{source_bucket}/{source_key} to {local_file_path}")
-                s3_client.download_file(source_bucket, source_key, str(local_file_path))
-                downloaded_files_count += 1
-            except Exception as e:
-                logger.error(f"Failed to download {s3_uri}: {e}")
+            parsed_uri = urlparse(s3_uri)
+            source_bucket = parsed_uri.netloc
+            source_key = parsed_uri.path.lstrip('/')
+            
+            if not source_bucket or not source_key:
+                logger.warning(f"Invalid S3 URI structure after parsing: {s3_uri}. Skipping.")
+                continue
+
+            download_tasks.append((s3_uri, source_bucket, source_key))
+
+        target_s3_key = "/".join(part for part in (ARCHIVE_S3_PREFIX.strip('/'), f"{zip_filename_base}.zip") if part)
+
+        # S3 GETs are dominated by per-object round-trips, so fetch them concurrently and
+        # zip each body as it arrives. The upload only starts once there is something to archive.
+        downloaded_files_count = 0
+        archive_stream = None
+        zipf = None
+        try:
+            if download_tasks:
+                with ThreadPoolExecutor(max_workers=min(DOWNLOAD_MAX_WORKERS, len(download_tasks))) as executor:
+                    # Only DOWNLOAD_MAX_WORKERS downloads are outstanding at a time; the next one
+                    # is submitted once a body has been zipped, so a zip writer blocked on a slow
+                    # upload also stops new downloads instead of letting finished bodies pile up
+                    pending_tasks = iter(download_tasks)
+                    futures = {}
+                    def submit_next():
+                        for s3_uri, source_bucket, source_key in islice(pending_tasks, 1):
+                            futures[executor.submit(fetch_s3_object, source_bucket, source_key)] = (s3_uri, source_key)
+                    for _ in range(DOWNLOAD_MAX_WORKERS):
+                        submit_next()
+                    while futures:
+                        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            s3_uri, source_key = futures.pop(future) # Drop the finished future so its body can be freed once zipped
+                            try:
+                                body = future.result()
+                            except Exception as e:
+                                logger.error(f"Failed to download {s3_uri}: {e}")
+                            else:
+                                if zipf is None:
+                                    logger.info(f"Writing archive to s3://{TARGET_S3_BUCKET_NAME}/{target_s3_key}")
+                                    archive_stream = ArchiveUploadStream(TARGET_S3_BUCKET_NAME, target_s3_key)
+                                    zipf = zipfile.ZipFile(archive_stream, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) # Fastest deflate; emails are short-lived text
+                                zipf.writestr(Path(source_key).name, body)
+                                del body
+                                downloaded_files_count += 1
+                            submit_next()
+            if zipf is not None:
+                zipf.close()
+                archive_stream.finish()
+        except Exception as e:
+            if archive_stream is not None:
+                archive_stream.abort(e)
+                try:
+                    zipf.close() # Release the ZipFile now rather than have it flush into the dead stream on GC
+                except Exception:
+                    pass
+            raise
+        logger.info(f"Archived {downloaded_files_count} of {len(download_tasks)} file(s)")
         
         if downloaded_files_count == 0:
             logger.warning("No files were successfully downloaded from the provided URIs.")
             return format_agent_response(event, 404, {"message": "No files were downloaded (either URIs were invalid or download failed), nothing to archive."})
-
-        zip_filename_base = local_tmp_archive_folder_name
-        zip_filepath_local = Path("/tmp") / f"{zip_filename_base}.zip"
-        
-        logger.info(f"Zipping contents of {local_tmp_path} to {zip_filepath_local}")
-        with zipfile.ZipFile(zip_filepath_local, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for item in local_tmp_path.rglob('*'):
-                if item.is_file():
-                    zipf.write(item, item.relative_to(local_tmp_path))
-        
-        target_s3_key = str(Path(ARCHIVE_S3_PREFIX) / f"{zip_filename_base}.zip").replace("\\", "/")
-        logger.info(f"Uploading {zip_filepath_local} to s3://{TARGET_S3_BUCKET_NAME}/{target_s3_key}")
-        s3_client.upload_file(str(zip_filepath_local), TARGET_S3_BUCKET_NAME, target_s3_key)
         
         archive_s3_path = f"s3://{TARGET_S3_BUCKET_NAME}/{target_s3_key}"
         success_message = f"Successfully archived {downloaded_files_count} email(s) related to '{query_context}' to {archive_s3_path}"
@@ -139,42 +327,23 @@ def lambda_handler(event, context):
     except Exception as e:
         logger.error(f"An error occurred during processing: {e}", exc_info=True)
         return format_agent_response(event, 500, {"error": f"Internal server error: {str(e)}"})
-    finally:
-        if 'local_tmp_path' in locals() and local_tmp_path.exists(): # Check if defined before using
-            logger.info(f"Cleaning up temporary folder: {local_tmp_path}")
-            shutil.rmtree(local_tmp_path, ignore_errors=True) # Add ignore_errors for robustness
-        if 'zip_filepath_local' in locals() and zip_filepath_local.exists():
-            logger.info(f"Cleaning up temporary zip file: {zip_filepath_local}")
-            try:
-                os.remove(zip_filepath_local)
-            except OSError as e_remove:
-                logger.error(f"Error removing zip file {zip_filepath_local}: {e_remove}")
 
 
 def format_agent_response(event_payload, http_status_code, response_data):
-    response_body_content = {
-        'application/json': {
-            'body': json.dumps(response_data) # Ensure response_data is always JSON serializable
-        }
-    }
-    action_group_name = event_payload.get('actionGroup', 'UnknownActionGroup') # Default if not present
+    get = event_payload.get
+    action_group_name = get('actionGroup', 'UnknownActionGroup') # Default if not present
     if isinstance(action_group_name, dict): # sometimes it's a dict with 'actionGroupName'
         action_group_name = action_group_name.get('actionGroupName', 'UnknownActionGroup')
 
-    api_path = event_payload.get('apiPath', 'UnknownApiPath')
-    http_method = event_payload.get('httpMethod', 'POST')
-
-    agent_response = {
+    return {
         'messageVersion': '1.0', 
         'response': {
             'actionGroup': action_group_name,
-            'apiPath': api_path,
-            'httpMethod': http_method,
+            'apiPath': get('apiPath', 'UnknownApiPath'),
+            'httpMethod': get('httpMethod', 'POST'),
             'httpStatusCode': http_status_code,
-            'responseBody': response_body_content
+            'responseBody': {'application/json': {'body': to_json(response_data)}} # Ensure response_data is always JSON serializable
         },
-        'sessionAttributes': event_payload.get('sessionAttributes', {}),
-        'promptSessionAttributes': event_payload.get('promptSessionAttributes', {})
+        'sessionAttributes': get('sessionAttributes') or {},
+        'promptSessionAttributes': get('promptSessionAttributes') or {}
     }
-    logger.info(f"Returning agent response: {json.dumps(agent_response)}")
-    return agent_response
\ No newline at end of file
@@ -0,0 +1,313 @@
+"""
+Shared plumbing for the MBOX converter scripts: splitting the MBOX into messages,
+running a per-message function over them in worker processes, and writing the
+results out (one file per email, or a single tar/SQLite file).
+Each script keeps its own parsing and filtering in its _process_one().
+"""
+import os
+import argparse
+import io
+import mmap
+import re
+import logging
+import tarfile
+import sqlite3
+import time
+import queue
+import threading
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+try:
+    # Optional: lexbor-backed HTML parser, strips tags in one C pass (pip install selectolax)
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
+
+# Number of messages handed to a worker process at a time
+MESSAGES_PER_CHUNK = 32
+# Files waiting for a worker's writer thread; parsing blocks once this many are queued
+WRITE_QUEUE_SIZE = 64
+
+# Output files are written with raw fds, skipping the text-mode encoding layer
+_WRITE_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0)
+_HAS_WRITEV = hasattr(os, "writev")
+# Separator between the metadata header and the email content, encoded once
+CONTENT_SEP = b"\n\n--- Email Content ---\n"
+
+# Regexes used on every HTML email, compiled once
+_HTML_BLOCK_RE = re.compile(r'<(style|script|head)(?:\s[^>]*)?>.*?</\1\s*>', re.DOTALL | re.IGNORECASE) # <style>, <script> and <head> blocks in one pass
+_TAG_RE = re.compile(r'<[^>]+>')
+_WS_RE = re.compile(r'\s+')
+
+def decode_payload(payload, charset):
+    """
+    Decodes a MIME part payload. Undecodable bytes become lone surrogates, which the
+    'replace' encode at the write site turns into '?'. Codecs that can't take
+    surrogateescape (utf-16, utf-7, iso-2022-jp, ...) are retried with errors='replace'.
+    """
+    try:
+        return payload.decode(charset, errors='surrogateescape')
+    except UnicodeDecodeError:
+        return payload.decode(charset, errors='replace')
+
+def html_to_text(html):
+    """Converts HTML to plain text with normalized whitespace."""
+    if LexborHTMLParser is not None:
+        # Encoded here so stray bytes (lone surrogates from decode_payload) become '?',
+        # as they do on the regex path, instead of being dropped by the parser
+        tree = LexborHTMLParser(html.encode('utf-8', 'replace'))
+        tree.strip_tags(['style', 'script', 'head'])
+        text_body = tree.text(separator=' ')
+    else:
+        # Basic regex conversion (used when selectolax is not installed)
+        text_body = _HTML_BLOCK_RE.sub('', html) # Remove style, script and head blocks
+        text_body = _TAG_RE.sub(' ', text_body) # Remove all other tags, replace with space
+    return _WS_RE.sub(' ', text_body).strip() # Normalize whitespace
+
+def write_buffers(filepath, buffers):
+    """
+    Writes already-encoded byte buffers to a file with a single open/writev/close,
+    without joining them into one bytes object first.
+    """
+    fd = os.open(filepath, _WRITE_FLAGS, 0o644)
+    try:
+        views = [memoryview(buffer) for buffer in buffers if buffer]
+        while views:
+            # os.writev is POSIX-only; elsewhere the buffers go out one write at a time
+            written = os.writev(fd, views) if _HAS_WRITEV else os.write(fd, views[0])
+            while written: # Drop what was written, keeping any partially written tail
+                if written >= len(views[0]):
+                    written -= len(views.pop(0))
+                else:
+                    views[0] = views[0][written:]
+                    written = 0
+    finally:
+        os.close(fd)
+
+class TarSink:
+    """Appends converted emails to one uncompressed tar archive instead of separate files."""
+
+    def __init__(self, path):
+        self.tar = tarfile.open(path, "w")
+        self.mtime = time.time()
+
+    def add(self, records):
+        for filename, payload in records:
+            info = tarfile.TarInfo(name=filename)
+            info.size = len(payload)
+            info.mtime = self.mtime
+            info.mode = 0o644
+            self.tar.addfile(info, io.BytesIO(payload))
+
+    def close(self):
+        self.tar.close()
+
+class SqliteSink:
+    """
+    Stores converted emails as rows of one SQLite table, committing in batches.
+    The table is recreated on every run.
+    """
+
+    BATCH_SIZE = 1000
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript("PRAGMA journal_mode=WAL; DROP TABLE IF EXISTS msgs; CREATE TABLE msgs(name TEXT PRIMARY KEY, content BLOB)")
+        self.pending = []
+
+    def add(self, records):
+        self.pending.extend(records)
+        if len(self.pending) >= self.BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        with self.conn: # Commits the batch
+            self.conn.executemany("INSERT OR REPLACE INTO msgs VALUES (?, ?)", self.pending)
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+def positive_int(value):
+    """argparse type for --workers: an integer of at least 1."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
+# --sink choices other than "dir": sink class and the file it creates in the output directory
+SINKS = {
+    "tar": (TarSink, "emails.tar"),
+    "sqlite": (SqliteSink, "emails.sqlite"),
+}
+
+def scan_offsets(mbox_file_path):
+    """
+    Finds every message in an MBOX file without parsing it.
+    Returns a list of (start, end) byte ranges, each excluding the "From " separator line.
+    """
+    if os.path.getsize(mbox_file_path) == 0:
+        return []
+    with open(mbox_file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        from_lines = [0] if mm[:5] == b'From ' else []
+        pos = mm.find(b'\nFrom ')
+        while pos >= 0:
+            from_lines.append(pos + 1)
+            pos = mm.find(b'\nFrom ', pos + 1)
+        from_lines.append(len(mm))
+
+        ranges = []
+        for from_line, next_from_line in zip(from_lines, from_lines[1:]):
+            start = mm.find(b'\n', from_line, next_from_line) + 1 or next_from_line # Skip the "From " line itself
+            end = next_from_line
+            if mm[end - 2:end] == b'\n\n':
+                end -= 1 # Drop the blank line that separates messages
+            ranges.append((start, max(start, end)))
+    return ranges
+
+def _temp_path(output_dir, filename, email_number):
+    """Path a worker writes an email to before the parent renames it to its final name."""
+    return os.path.join(output_dir, f"{filename}.{email_number}.tmp")
+
+def _unique_name(filename, email_number, used_names):
+    """
+    Returns filename, or filename with the email number appended if an earlier email
+    of this run already took that name, and records the result in used_names.
+    """
+    if filename in used_names:
+        stem, ext = os.path.splitext(filename)
+        filename = f"{stem}_{email_number}{ext}"
+        while filename in used_names:
+            stem, ext = os.path.splitext(filename)
+            filename = f"{stem}_{email_number}{ext}"
+    used_names.add(filename)
+    return filename
+
+def _write_queued_files(write_queue, failed_writes):
+    """
+    Writer thread: writes (email_number, filepath, buffers) items from write_queue until it
+    gets None. Numbers of the emails that could not be written are added to failed_writes.
+    """
+    while True:
+        item = write_queue.get()
+        if item is None:
+            return
+        email_number, filepath, buffers = item
+        try:
+            write_buffers(filepath, buffers)
+        except Exception as e:
+            logging.error(f"Error writing file {os.path.basename(filepath)}: {e}")
+            failed_writes.add(email_number)
+            try:
+                os.unlink(filepath)
+            except OSError:
+                pass
+
+def _process_range_chunk(mbox_file_path, output_path, chunk, process_one, failed_write_status):
+    """
+    Worker entry point: maps the MBOX file and runs process_one over one chunk of
+    (email_number, start, end) ranges. Files are handed to a writer thread so
+    parsing continues while they are written to temporary paths in output_path,
+    and the parent renames them into place; when output_path is None the content
+    is returned to the parent instead.
+    Returns (Counter of outcomes, records), where records are
+    (email_number, filename, content bytes or None) in email order.
+    """
+    counts = Counter()
+    records = []
+    failed_writes = set()
+    write_queue = None
+    if output_path is not None:
+        write_queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+        writer = threading.Thread(target=_write_queued_files, args=(write_queue, failed_writes), daemon=True)
+        writer.start()
+    # Bound methods used per email, looked up once per chunk
+    add_record = records.append
+    output_dir = str(output_path) if output_path is not None else None
+    try:
+        with open(mbox_file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for email_number, start, end in chunk:
+                status, filename, payload = process_one(mm[start:end], email_number)
+                if payload is not None:
+                    if write_queue is None:
+                        add_record((email_number, filename, b"".join(payload)))
+                    else:
+                        write_queue.put((email_number, _temp_path(output_dir, filename, email_number), payload))
+                        add_record((email_number, filename, None))
+                counts[status] += 1
+    finally:
+        if write_queue is not None:
+            write_queue.put(None)
+            writer.join()
+
+    # Emails whose file could not be written were counted as processed above
+    if failed_writes:
+        records = [record for record in records if record[0] not in failed_writes]
+        counts["processed"] -= len(failed_writes)
+        counts[failed_write_status] += len(failed_writes)
+    return counts, records
+
+def convert_mbox(mbox_file_path, output_path, process_one, failed_write_status, workers=None, sink="dir",
+                 progress_every=100, progress_message="Processed {count} emails..."):
+    """
+    Runs process_one(raw_bytes, email_number) over every message of an MBOX file in a
+    pool of worker processes. It must be a module-level function returning
+    (status, filename, payload), where payload is a sequence of bytes buffers or None.
+    Results go to one file per email in output_path, or with sink="tar"/"sqlite" into a
+    single file there. An email whose filename repeats an earlier one's in the same run
+    is saved with its email number appended (e.g. name_42.txt). Emails whose file can't be written are counted as failed_write_status.
+    Returns a Counter of statuses, or None if the MBOX file could not be read.
+    """
+    try:
+        ranges = scan_offsets(mbox_file_path)
+    except Exception as e:
+        logging.error(f"Error opening MBOX file {mbox_file_path}: {e}")
+        return None
+
+    numbered_ranges = [(i + 1, start, end) for i, (start, end) in enumerate(ranges)]
+    chunks = [numbered_ranges[i:i + MESSAGES_PER_CHUNK] for i in range(0, len(numbered_ranges), MESSAGES_PER_CHUNK)]
+
+    record_sink = None
+    if sink in SINKS:
+        sink_class, sink_filename = SINKS[sink]
+        record_sink = sink_class(output_path / sink_filename)
+        logging.info(f"Writing all emails to: {(output_path / sink_filename).resolve()}")
+
+    totals = Counter()
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            worker_output_path = output_path if record_sink is None else None
+            results = executor.map(
+                _process_range_chunk, repeat(mbox_file_path), repeat(worker_output_path), chunks,
+                repeat(process_one), repeat(failed_write_status),
+            )
+            used_names = set()
+            for counts, records in results:
+                # Names are settled here, in email order, so an email whose filename repeats
+                # an earlier one's gets the email number appended in every sink alike
+                if record_sink is None:
+                    for email_number, filename, _ in records:
+                        temp_path = _temp_path(output_path, filename, email_number)
+                        try:
+                            os.replace(temp_path, output_path / _unique_name(filename, email_number, used_names))
+                        except OSError as e:
+                            logging.error(f"Error writing file {filename}: {e}")
+                            counts["processed"] -= 1
+                            counts[failed_write_status] += 1
+                elif records:
+                    record_sink.add([
+                        (_unique_name(filename, email_number, used_names), content)
+                        for email_number, filename, content in records
+                    ])
+                previous_processed = totals["processed"]
+                totals.update(counts)
+                if totals["processed"] // progress_every > previous_processed // progress_every:
+                    logging.info(progress_message.format(count=totals["processed"] // progress_every * progress_every))
+    finally:
+        # Close the sink even if a worker died, so the tar/SQLite file is left readable
+        if record_sink is not None:
+            record_sink.close()
+    return totals
@@ -1,15 +1,27 @@
-import mailbox
-import os
 import re
 from email import policy
-from email.parser import BytesParser
-from email.utils import parsedate_to_datetime, getaddresses
+from email.parser import BytesParser, BytesHeaderParser
+from email.utils import parsedate_to_datetime
 from datetime import datetime
 import logging
 from pathlib import Path
 import argparse
 import hashlib
 
+from mbox_common import CONTENT_SEP, SINKS, convert_mbox, decode_payload, html_to_text, positive_int
+
+try:
+    # Optional: Aho-Corasick automaton, matches all keywords in one pass (pip install pyahocorasick)
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+try:
+    # Optional: Hyperscan multi-pattern matcher, used when pyahocorasick is missing (pip install hyperscan)
+    import hyperscan
+except ImportError:
+    hyperscan = None
+
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -28,26 +40,52 @@ SOCIAL_MEDIA_KEYWORDS = [
     "quora.com", "quora",
     "nextdoor.com", "nextdoor",
     "flipkart", "amazon India", "amazon.com", "amazon",
-    "myntra", "myntra.com", "myntra",
+    "myntra", "myntra.com",
     "gmail", "google", "google Play", "google photos", "google drive",
     "badoo.com", "badoo",
     "internshala", "topmate.io", "internshala.com", "tata", "jobscan",
     "alerts", "monsterindia.com", "foundit", "oracle.com", "careers", "no-reply", "job", "jobs", "india", "noreply", "participate",
     "cuvette", "cuvette.tech", "myworkdayjobs", "myworkday", "myworkday.com",
     "indeed.com", "indeed", "indeed.co.in", "indeed.co.uk", "indeed.co.jp", "tax", "crypto", "binance", "do_not_reply", "contests", "mercer", "hasura", "jobnotification",
-    "credit", "CreditMantri", "creditmantri.com", "creditmantri",
+    "credit", "CreditMantri", "creditmantri.com",
     "zomato.com", "zomato", "swiggy.com", "swiggy",
     "unacademy.com", "unacademy", "cesc", "jio.com", "jio",
-    "paytm.com", "paytm", "grammarly.com", "grammarly", "irctc.co.in", "irctc", "irctc.co.in",
-    "snapdeal.com", "snapdeal", "snapdeal.com", "snapdeal", "toornament", "udemy.com", "udemy",
-    "coursera.org", "coursera", "coursera.com", "coursera", "skillshare.com", "skillshare",
-    "edx.org", "edx", "edx.com", "edx", "gifting", "gift", "giftcards", "skillshare.com", "skillshare",
+    "paytm.com", "paytm", "grammarly.com", "grammarly", "irctc.co.in", "irctc",
+    "snapdeal.com", "snapdeal", "toornament", "udemy.com", "udemy",
+    "coursera.org", "coursera", "coursera.com", "skillshare.com", "skillshare",
+    "edx.org", "edx", "edx.com", "gifting", "gift", "giftcards",
     
     # Add more services or specific sender names if needed
     # "notifications@examplecompany.com",
 ]
-# Convert to lowercase for case-insensitive matching
-SOCIAL_MEDIA_KEYWORDS_LOWER = [keyword.lower() for keyword in SOCIAL_MEDIA_KEYWORDS]
+# Convert to lowercase for case-insensitive matching (dropping any duplicates)
+SOCIAL_MEDIA_KEYWORDS_LOWER = list(dict.fromkeys(keyword.lower() for keyword in SOCIAL_MEDIA_KEYWORDS))
+# Keywords that are plain hostnames, checked first against the sender's domain
+_EXACT_DOMAINS = frozenset(keyword for keyword in SOCIAL_MEDIA_KEYWORDS_LOWER if "." in keyword and "@" not in keyword and " " not in keyword)
+
+# All keywords compiled into one automaton (or Hyperscan database), so each From header is scanned once
+_SOCIAL_AC = None
+_SOCIAL_HS = None
+if ahocorasick is not None:
+    _SOCIAL_AC = ahocorasick.Automaton()
+    for keyword in SOCIAL_MEDIA_KEYWORDS_LOWER:
+        _SOCIAL_AC.add_word(keyword, keyword)
+    _SOCIAL_AC.make_automaton()
+elif hyperscan is not None:
+    _SOCIAL_HS = hyperscan.Database()
+    _SOCIAL_HS.compile(
+        expressions=[re.escape(keyword).encode() for keyword in SOCIAL_MEDIA_KEYWORDS_LOWER],
+        ids=list(range(len(SOCIAL_MEDIA_KEYWORDS_LOWER))),
+        elements=len(SOCIAL_MEDIA_KEYWORDS_LOWER),
+        flags=hyperscan.HS_FLAG_SINGLEMATCH,
+    )
+
+# Characters not suitable for filenames, compiled once
+_FN_BAD_RE = re.compile(r'[\\/*?:"<>|\r\n]')
+
+# Raw message bytes (one slice of the mmapped MBOX) go straight to the parser
+_parse_message = BytesParser(policy=policy.default).parsebytes
+_parse_headers = BytesHeaderParser(policy=policy.default).parsebytes
 
 
 def get_email_body(msg):
@@ -61,37 +99,51 @@ def get_email_body(msg):
     html_body_content = ""
 
     if msg.is_multipart():
-        for part in msg.walk():
+        html_parts = []
+        # Depth-first over the MIME tree, never descending into attachments
+        parts = [msg]
+        while parts:
+            part = parts.pop()
+            content_disposition = part.get("Content-Disposition")
+            if content_disposition and "attachment" in str(content_disposition): # Ignore attachments
+                continue
+            if part.is_multipart():
+                parts.extend(reversed(part.get_payload())) # Reversed so parts come off in document order
+                continue
+
             content_type = part.get_content_type()
-            content_disposition = str(part.get("Content-Disposition"))
-
-            if "attachment" not in content_disposition: # Ignore attachments
-                if content_type == "text/plain":
-                    try:
-                        payload = part.get_payload(decode=True)
-                        charset = part.get_content_charset() or 'utf-8'
-                        preferred_body = payload.decode(charset, errors='replace')
-                        # If plain text is found, we prefer it, so break
-                        # unless it's an alternative part and html might be richer
-                        # For simplicity now, we'll take the first good plain text.
-                        break
-                    except Exception as e:
-                        logging.debug(f"Could not decode text/plain part: {e}") # Debug for less noise
-                elif content_type == "text/html":
-                    try:
-                        payload = part.get_payload(decode=True)
-                        charset = part.get_content_charset() or 'utf-8'
-                        html_body_content = payload.decode(charset, errors='replace')
-                    except Exception as e:
-                        logging.debug(f"Could not decode text/html part: {e}") # Debug for less noise
+            if content_type == "text/plain":
+                try:
+                    payload = part.get_payload(decode=True)
+                    charset = part.get_content_charset() or 'utf-8'
+                    preferred_body = decode_payload(payload, charset)
+                    # If plain text is found, we prefer it, so break
+                    # unless it's an alternative part and html might be richer
+                    # For simplicity now, we'll take the first good plain text.
+                    break
+                except Exception as e:
+                    logging.debug(f"Could not decode text/plain part: {e}") # Debug for less noise
+            elif content_type == "text/html":
+                html_parts.append(part) # Only decoded below if no plain text part turns up
+
+        if not preferred_body:
+            for part in reversed(html_parts): # The last decodable HTML part is used
+                try:
+                    payload = part.get_payload(decode=True)
+                    charset = part.get_content_charset() or 'utf-8'
+                    html_body_content = decode_payload(payload, charset)
+                    break
+                except Exception as e:
+                    logging.debug(f"Could not decode text/html part: {e}") # Debug for less noise
     else: # Not a multipart message
         try:
             payload = msg.get_payload(decode=True)
             charset = msg.get_content_charset() or 'utf-8'
-            single_part_body = payload.decode(charset, errors='replace')
-            if msg.get_content_type() == "text/plain":
+            single_part_body = decode_payload(payload, charset)
+            content_type = msg.get_content_type()
+            if content_type == "text/plain":
                 preferred_body = single_part_body
-            elif msg.get_content_type() == "text/html":
+            elif content_type == "text/html":
                 html_body_content = single_part_body
         except Exception as e:
             logging.debug(f"Could not decode single part message: {e}") # Debug for less noise
@@ -100,160 +152,172 @@ def get_email_body(msg):
         body = preferred_body
     elif html_body_content: # If only HTML was found, convert it
         try:
-            # Basic HTML to text conversion
-            text_body = re.sub(r'<style(?:\s[^>]*)?>.*?</style>', '', html_body_content, flags=re.DOTALL | re.IGNORECASE)
-            text_body = re.sub(r'<script(?:\s[^>]*)?>.*?</script>', '', text_body, flags=re.DOTALL | re.IGNORECASE)
-            text_body = re.sub(r'<head(?:\s[^>]*)?>.*?</head>', '', text_body, flags=re.DOTALL | re.IGNORECASE) # Remove head
-            text_body = re.sub(r'<[^>]+>', ' ', text_body) # Remove all other tags, replace with space
-            text_body = re.sub(r'\s+', ' ', text_body).strip() # Normalize whitespace
-            body = text_body
+            body = html_to_text(html_body_content)
         except Exception as e:
             logging.warning(f"Could not convert HTML to text: {e}")
             body = "" # Fallback to empty if conversion fails
             
     return body.strip()
 
+def _as_str(value):
+    """Returns header values as str; policy.default headers already are str subclasses, so they pass through."""
+    return value if isinstance(value, str) else str(value)
+
 def clean_filename_component(component_str, max_len=50):
     """Cleans a string to be part of a filename."""
     if not component_str:
         return "unknown"
-    cleaned = re.sub(r'[\\/*?:"<>|]', "_", str(component_str)) # Ensure component_str is string
-    cleaned = cleaned.replace("\n", "_").replace("\r", "_")
-    return cleaned[:max_len].strip()
+    # Replace characters not suitable for filenames (including newlines) in one pass
+    return _FN_BAD_RE.sub("_", _as_str(component_str))[:max_len].strip() # Ensure component_str is string
+
+def _stop_scan(*args):
+    """Hyperscan match handler: returning True stops the scan at the first keyword hit."""
+    return True
 
 def is_social_media_email(msg_from_header_full):
     """Checks if the From header suggests a social media email."""
     if not msg_from_header_full:
         return False
     
-    from_header_lower = str(msg_from_header_full).lower() # Ensure it's a string
+    from_header_lower = _as_str(msg_from_header_full).lower() # Ensure it's a string
     
-    # getaddresses returns list of (realname, email_address)
-    # We check both parts
-    for realname, email_address in getaddresses([from_header_lower]):
-        check_strings = []
-        if email_address: check_strings.append(email_address)
-        if realname: check_strings.append(realname)
-        
-        for check_str in check_strings:
-            for keyword in SOCIAL_MEDIA_KEYWORDS_LOWER:
-                if keyword in check_str:
-                    return True
+    # Fast path: the sender's domain is one of the known hosts. The domain is
+    # sliced out of the header directly rather than running an address parser;
+    # anything unusual just falls through to the keyword scan below.
+    if from_header_lower.rpartition("@")[2].partition(">")[0].strip() in _EXACT_DOMAINS:
+        return True
+
+    # Keywords are matched against the whole header, which covers both
+    # the display name and the email address
+    if _SOCIAL_AC is not None:
+        return next(_SOCIAL_AC.iter(from_header_lower), None) is not None
+    if _SOCIAL_HS is not None:
+        try:
+            _SOCIAL_HS.scan(from_header_lower.encode('utf-8', errors='replace'), match_event_handler=_stop_scan)
+        except hyperscan.ScanTerminated:
+            return True
+        return False
+    for keyword in SOCIAL_MEDIA_KEYWORDS_LOWER:
+        if keyword in from_header_lower:
+            return True
     return False
 
 
-def process_mbox(mbox_file_path, output_dir):
+def _process_one(raw_bytes, email_number):
     """
-    Processes an MBOX file, extracts emails, prepends metadata,
-    filters out social media and no-body emails, and saves them as .txt files.
+    Parses one raw message, applies the filters, and builds its .txt content.
+    Returns (status, filename, payload); status is "processed", "social", "no_body"
+    or "error", payload is a (header bytes, body bytes) pair, and filename/payload
+    are None unless it is "processed".
     """
-    output_path = Path(output_dir)
-    output_path.mkdir(parents=True, exist_ok=True)
-    logging.info(f"Output directory: {output_path.resolve()}")
-    
+    from_header_full = None
     try:
-        mbox = mailbox.mbox(mbox_file_path, factory=BytesParser(policy=policy.default).parse)
-    except Exception as e:
-        logging.error(f"Error opening MBOX file {mbox_file_path}: {e}")
-        return
+        # Only the header block is parsed for the filter; most rejected
+        # messages never get their MIME body parsed
+        headers = _parse_headers(raw_bytes)
+        from_header_full = headers.get("From", "Unknown Sender") # This should be a string or Header object
+        # Ensure from_header_full is properly stringified, once, for both the filter and the metadata
+        from_display = _as_str(from_header_full)
 
-    processed_count = 0
-    skipped_no_body_count = 0
-    skipped_social_count = 0
-    error_count = 0
+        # --- Social Media Filter (applied first) ---
+        if is_social_media_email(from_display):
+            return "social", None, None
 
-    for i, msg in enumerate(mbox):
-        try:
-            from_header_full = msg.get("From", "Unknown Sender") # This should be a string or Header object
+        msg = _parse_message(raw_bytes)
 
-            # --- Social Media Filter (applied first) ---
-            if is_social_media_email(from_header_full):
-                skipped_social_count += 1
-                continue
+        # --- Body Extraction (applied second) ---
+        body = get_email_body(msg)
+        if not body:
+            return "no_body", None, None
+        
+        # --- Header Extraction for Metadata ---
+        date_str = msg.get("Date", "")
+        email_date = None
+        if date_str:
+            try: 
+                email_date = parsedate_to_datetime(_as_str(date_str)) # Ensure date_str is string
+            except Exception: 
+                logging.debug(f"Could not parse date for email {email_number}") # Debug for less noise
 
-            # --- Body Extraction (applied second) ---
-            body = get_email_body(msg)
-            if not body:
-                skipped_no_body_count += 1
-                continue
-            
-            # --- Header Extraction for Metadata ---
-            date_str = msg.get("Date", "")
-            email_date = None
-            if date_str:
-                try: 
-                    email_date = parsedate_to_datetime(str(date_str)) # Ensure date_str is string
-                except Exception: 
-                    logging.debug(f"Could not parse date for email {i+1}") # Debug for less noise
-
-            subject = str(msg.get("Subject", "No Subject"))
-            # Ensure from_header_full is properly stringified for metadata
-            from_display = str(from_header_full)
-            
-            to_headers_full_list = msg.get_all("To", [])
-            to_display = ", ".join([str(h) for h in to_headers_full_list]) if to_headers_full_list else "Unknown Recipient"
-            
-            cc_headers_full_list = msg.get_all("Cc", [])
-            cc_display = ", ".join([str(h) for h in cc_headers_full_list]) if cc_headers_full_list else ""
+        subject = _as_str(msg.get("Subject", "No Subject"))
+        
+        to_headers_full_list = msg.get_all("To", [])
+        to_display = ", ".join([_as_str(h) for h in to_headers_full_list]) if to_headers_full_list else "Unknown Recipient"
+        
+        cc_headers_full_list = msg.get_all("Cc", [])
+        cc_display = ", ".join([_as_str(h) for h in cc_headers_full_list]) if cc_headers_full_list else ""
 
 
-            message_id = str(msg.get("Message-ID", ""))
+        message_id = _as_str(msg.get("Message-ID", ""))
 
-            # --- Metadata Prepending ---
-            metadata_header_parts = []
-            date_display_str = email_date.strftime('%Y-%m-%d %H:%M:%S %Z') if email_date else "Unknown"
-            metadata_header_parts.append(f"Email Date: {date_display_str}")
-            metadata_header_parts.append(f"From: {from_display}")
-            metadata_header_parts.append(f"To: {to_display}")
-            if cc_display: # Only add Cc if present and not empty
-                 metadata_header_parts.append(f"Cc: {cc_display}")
-            metadata_header_parts.append(f"Subject: {subject}")
-            
-            metadata_string = "\n".join(metadata_header_parts) + "\n\n--- Email Content ---\n"
-            final_content = metadata_string + body
+        # --- Metadata Prepending ---
+        metadata_header_parts = []
+        date_display_str = email_date.strftime('%Y-%m-%d %H:%M:%S %Z') if email_date else "Unknown"
+        metadata_header_parts.append(f"Email Date: {date_display_str}")
+        metadata_header_parts.append(f"From: {from_display}")
+        metadata_header_parts.append(f"To: {to_display}")
+        if cc_display: # Only add Cc if present and not empty
+             metadata_header_parts.append(f"Cc: {cc_display}")
+        metadata_header_parts.append(f"Subject: {subject}")
+        
+        header_bytes = "\n".join(metadata_header_parts).encode("utf-8", "replace") + CONTENT_SEP
 
-            # --- Filename Creation ---
-            date_prefix = email_date.strftime("%Y%m%d_%H%M%S") if email_date else "NODATE"
-            
-            unique_id_part = clean_filename_component(message_id.strip("<>").replace("@", "_at_"), 70) if message_id else hashlib.md5((subject + body[:200]).encode('utf-8', errors='replace')).hexdigest()[:12]
-            
-            subject_part = clean_filename_component(subject, 40)
-            filename = f"{date_prefix}_{subject_part}_{unique_id_part}.txt"
-            filepath = output_path / filename
-
-            try:
-                with open(filepath, "w", encoding="utf-8") as f:
-                    f.write(final_content)
-                processed_count += 1
-                if (processed_count % 500 == 0) and processed_count > 0: # Log every 500 processed
-                    logging.info(f"Processed {processed_count} emails matching filters...")
-            except Exception as e:
-                logging.error(f"Error writing file {filename}: {e}")
-                error_count +=1
-        except Exception as e:
-            logging.error(f"Critical error processing email index {i}: {e}")
-            error_count += 1
-            # For debugging the error you saw: 'str' object has no attribute 'token_type'
-            # This error usually comes from the email.header.decode_header function
-            # if it receives a plain string instead of a Header object or bytes.
-            # The use of BytesParser(policy=policy.default) should generally prevent this,
-            # but let's log the problematic header if it happens.
-            if "token_type" in str(e):
-                logging.error(f"Problematic 'From' header for email index {i}: {from_header_full} (type: {type(from_header_full)})")
+        # --- Filename Creation ---
+        date_prefix = email_date.strftime("%Y%m%d_%H%M%S") if email_date else "NODATE"
+        
+        if message_id:
+            unique_id_part = clean_filename_component(message_id.strip("<>").replace("@", "_at_"), 70)
+        else:
+            fallback_hash = hashlib.blake2b(subject.encode('utf-8', errors='replace'), digest_size=6)
+            fallback_hash.update(body[:200].encode('utf-8', errors='replace'))
+            unique_id_part = fallback_hash.hexdigest()
+        
+        subject_part = clean_filename_component(subject, 40)
+        filename = f"{date_prefix}_{subject_part}_{unique_id_part}.txt"
+        return "processed", filename, (header_bytes, body.encode("utf-8", "replace"))
+    except Exception as e:
+        logging.error(f"Critical error processing email index {email_number - 1}: {e}")
+        # For debugging the error you saw: 'str' object has no attribute 'token_type'
+        # This error usually comes from the email.header.decode_header function
+        # if it receives a plain string instead of a Header object or bytes.
+        # The use of BytesParser(policy=policy.default) should generally prevent this,
+        # but let's log the problematic header if it happens.
+        if "token_type" in str(e):
+            logging.error(f"Problematic 'From' header for email index {email_number - 1}: {from_header_full} (type: {type(from_header_full)})")
+        return "error", None, None
 
+def process_mbox(mbox_file_path, output_dir, workers=None, sink="dir"):
+    """
+    Processes an MBOX file, extracts emails, prepends metadata,
+    filters out social media and no-body emails, and saves them as .txt files.
+    Messages are parsed and written in parallel by a pool of worker processes.
+    With sink="tar" or "sqlite", all emails go into a single file in output_dir instead.
+    """
+    output_path = Path(output_dir)
+    output_path.mkdir(parents=True, exist_ok=True)
+    logging.info(f"Output directory: {output_path.resolve()}")
+    
+    totals = convert_mbox(
+        mbox_file_path, output_path, _process_one, "error", workers, sink,
+        progress_every=500, progress_message="Processed {count} emails matching filters...",
+    )
+    if totals is None:
+        return
 
     logging.info(f"--- Processing Complete ---")
-    logging.info(f"Successfully processed and saved: {processed_count} emails.")
-    logging.info(f"Skipped (social media filter): {skipped_social_count} emails.")
-    logging.info(f"Skipped (no body): {skipped_no_body_count} emails.")
-    logging.info(f"Errors during processing: {error_count} emails.")
+    logging.info(f"Successfully processed and saved: {totals['processed']} emails.")
+    logging.info(f"Skipped (social media filter): {totals['social']} emails.")
+    logging.info(f"Skipped (no body): {totals['no_body']} emails.")
+    logging.info(f"Errors during processing: {totals['error']} emails.")
     logging.info(f"Output files are in: {output_path.resolve()}")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Convert MBOX to .txt files, filtering out social media and no-body emails.")
     parser.add_argument("mbox_file", help="Path to the MBOX file.")
     parser.add_argument("output_directory", help="Directory to save the processed .txt files.")
+    parser.add_argument("--workers", type=positive_int, default=None, help="Number of worker processes (default: one per CPU).")
+    parser.add_argument("--sink", choices=["dir", *SINKS], default="dir", help="Write one .txt file per email (dir, the default), or put them all in a single emails.tar or emails.sqlite.")
     
     args = parser.parse_args()
     
-    process_mbox(args.mbox_file, args.output_directory)
\ No newline at end of file
+    process_mbox(args.mbox_file, args.output_directory, args.workers, args.sink)
\ No newline at end of file
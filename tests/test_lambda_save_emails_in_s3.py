@@ -0,0 +1,60 @@
+import importlib.util
+import json
+import os
+import threading
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("moto")
+import boto3
+from moto import mock_aws
+
+CODES_DIR = Path(__file__).resolve().parent.parent / "codes"
+
+
+def load_lambda():
+    """Imports codes/Lambda-to-save-emails-in-s3.py (its file name is not a valid module name)."""
+    spec = importlib.util.spec_from_file_location("save_emails_lambda", CODES_DIR / "Lambda-to-save-emails-in-s3.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def agent_event(s3_uris):
+    event = json.loads((CODES_DIR / "Lambda-to-save-emails-in-s3-test.json").read_text())
+    event["requestBody"]["application/json"]["properties"][0]["value"] = s3_uris
+    return event
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setenv("TARGET_S3_BUCKET_NAME", "archive-bucket")
+    with mock_aws():
+        s3 = boto3.client("s3")
+        s3.create_bucket(Bucket="source-bucket")
+        yield s3
+
+
+def test_failed_streamed_upload_returns_500(aws):
+    # Incompressible sources push the archive past ARCHIVE_SPOOL_THRESHOLD, so it is
+    # streamed as a multipart upload; the target bucket does not exist, so that upload fails
+    uris = []
+    for i in range(6):
+        aws.put_object(Bucket="source-bucket", Key=f"email_{i}.bin", Body=os.urandom(6 * 1024 * 1024))
+        uris.append(f"s3://source-bucket/email_{i}.bin")
+    save_emails_lambda = load_lambda()
+
+    result = {}
+    handler = threading.Thread(
+        target=lambda: result.update(response=save_emails_lambda.lambda_handler(agent_event(uris), None)),
+        daemon=True,
+    )
+    handler.start()
+    handler.join(timeout=120)
+
+    assert not handler.is_alive(), "lambda_handler hung after the upload failed"
+    assert result["response"]["response"]["httpStatusCode"] == 500